@@ -0,0 +1,72 @@
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+from aiogram.types import Message
+from generation import GenerationQueue
+from storage import Storage
+from styles import SUBSTYLE_BY_TITLE
+
+# === ДОПУСК К РЕНДЕРУ ===
+# Middleware для хендлеров с флагом render: каждый пропущенный запрос — это
+# 45 секунд SDXL, которые ждут все остальные. Поэтому до хендлера (и до списания
+# генерации) отсекаем двойные нажатия, повторы уже идущих задач, превышение
+# лимитов пользователя и бесплатные запросы, когда очередь и так длинная.
+
+
+class RenderAdmission(BaseMiddleware):
+    def __init__(self, queue: GenerationQueue, storage: Storage, max_active_per_user: int = 2,
+                 max_per_minute: int = 3, queue_limit: int = 12):
+        self.queue = queue
+        self.storage = storage
+        self.max_active_per_user = max_active_per_user
+        self.max_per_minute = max_per_minute
+        # Дальше этой длины очереди пускаем только пользователей с оплаченным балансом
+        self.queue_limit = queue_limit
+        # user_id → текст кнопки запроса, который сейчас в хендлере
+        self._handling = {}
+
+    async def __call__(self, handler, event: Message, data: dict):
+        if not get_flag(data, "render"):
+            return await handler(event, data)
+        user_id = event.from_user.id
+        if user_id in self._handling:
+            # Обновления обрабатываются параллельно: второе нажатие прошло бы
+            # фильтр состояния раньше, чем первое его сменит
+            if self._handling[user_id] != event.text:
+                await event.answer("⏳ Подожди секунду, обрабатываю предыдущий запрос.")
+            return None
+        # Слот занимаем до первого await: проверки ниже ходят в базу, и второе
+        # нажатие успело бы проскочить мимо
+        self._handling[user_id] = event.text
+        try:
+            rejection = await self._check(event, data)
+            if rejection:
+                await event.answer(rejection)
+                return None
+            return await handler(event, data)
+        finally:
+            self._handling.pop(user_id, None)
+
+    async def _check(self, event: Message, data: dict):
+        user_id = event.from_user.id
+        user_data = await data["state"].get_data()
+        main_style = user_data.get("main_style")
+        duplicate = self.queue.find(
+            user_id, user_data.get("photo_key"), main_style, SUBSTYLE_BY_TITLE.get((main_style, event.text))
+        )
+        if duplicate is not None:
+            if duplicate in self.queue.pending:
+                position = self.queue.position(duplicate)
+                return f"🕒 Этот стиль с этим фото уже в очереди: {position}-й, ~{self.queue.eta(position)} сек."
+            return "🔄 Этот стиль с этим фото уже генерируется — результат скоро будет."
+        if self.queue.user_jobs(user_id) >= self.max_active_per_user:
+            return "⏳ Дождись готовых картинок — потом можно заказать ещё."
+        if self.queue.user_rate(user_id) >= self.max_per_minute:
+            return "⏳ Слишком много запросов подряд. Попробуй через минуту."
+        waiting = len(self.queue.pending)
+        if waiting >= self.queue_limit and await self.storage.get_balance(user_id) <= 0:
+            minutes = max(1, round(self.queue.eta(waiting + 1) / 60))
+            return (
+                f"⏳ Сейчас в очереди {waiting} задач — бесплатное превью было бы готово "
+                f"только через ~{minutes} мин. Попробуй чуть позже."
+            )
+        return None
@@ -0,0 +1,217 @@
+import argparse
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+
+# Бенчмарк пайплайна генерации на CPU: тот же load_model(), что и у бота,
+# фиксированный набор стилей и сид, поэтапные тайминги и итог в JSON
+# для сравнения между коммитами.
+#
+#   python bench.py --faces samples/face1.jpg samples/face2.jpg --out bench.json
+#   python bench.py --faces samples/face1.jpg --precision int8 --steps 20 --profile trace.json
+#   python bench.py --imports-only --import-budget 1.0
+#
+# Время импорта (python -X importtime) меряется в чистом процессе для каждого модуля:
+# фронтенд бота должен стартовать быстро и без torch.
+IMPORT_TARGETS = ("bot_local", "styles", "torch", "diffusers", "model")
+FRONTEND = "bot_local"
+BENCH_STYLES = [
+    "new_year/snow",
+    "premium/golden_hour",
+    "photo_studio/white",
+    "cyberpunk/neon_rain",
+    "female_portrait/warm_sweater",
+    "male_portrait/street_portrait",
+    "studio/bw_man_suit",
+]
+
+
+def summarize(values: list) -> dict:
+    return {
+        "mean": statistics.fmean(values),
+        "p50": statistics.median(values),
+        "max": max(values),
+    }
+
+
+def measure_import(module: str) -> dict:
+    # bot_local без токена не импортируется; сам бот при импорте в сеть не ходит
+    env = {**os.environ, "TELEGRAM_BOT_TOKEN": os.getenv("TELEGRAM_BOT_TOKEN") or "0:bench"}
+    started = time.perf_counter()
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, env=env, cwd=os.path.dirname(os.path.abspath(__file__))
+    )
+    wall_seconds = time.perf_counter() - started
+    # Строки вида "import time:   self |  cumulative | [отступ]пакет"
+    top_level = {}
+    loaded = set()
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|")
+        if not cumulative.strip().isdigit():
+            continue
+        loaded.add(name.strip())
+        if not name[1:].startswith(" "):
+            top_level[name.strip()] = int(cumulative) / 1e6
+    heaviest = sorted(top_level.items(), key=lambda item: item[1], reverse=True)[:5]
+    return {
+        "ok": result.returncode == 0,
+        "import_seconds": sum(top_level.values()),
+        "wall_seconds": wall_seconds,
+        "loads_torch": "torch" in loaded,
+        "heaviest": dict(heaviest),
+    }
+
+
+def peak_rss_mb() -> float:
+    # ru_maxrss в Linux — в килобайтах
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк SDXL + IP-Adapter на CPU")
+    parser.add_argument("--faces", nargs="+", help="фото лиц для IP-Adapter")
+    parser.add_argument("--styles", nargs="+", default=BENCH_STYLES, help="main_style/substyle")
+    parser.add_argument("--precision", default="fp32", choices=("fp32", "bf16", "int8"))
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--batch", type=int, default=1, help="задач в одном проходе UNet")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--no-channels-last", action="store_true")
+    parser.add_argument("--compile", action="store_true", help="torch.compile для UNet")
+    parser.add_argument("--profile", help="сохранить trace torch.profiler (chrome://tracing) в файл")
+    parser.add_argument("--imports-only", action="store_true", help="только время импорта, без рендера")
+    parser.add_argument("--import-budget", type=float, default=1.5,
+                        help="сколько секунд можно тратить на импорт фронтенда")
+    parser.add_argument("--out", default="bench.json")
+    args = parser.parse_args()
+    if not args.faces and not args.imports_only:
+        parser.error("нужен --faces или --imports-only")
+
+    # Импорты меряем до того, как torch попадёт в этот процесс
+    imports = {module: measure_import(module) for module in IMPORT_TARGETS}
+    print("📦 Импорт:")
+    for module, stats in imports.items():
+        status = "" if stats["ok"] else " (ошибка импорта)"
+        print(f"  {module:<13} {stats['import_seconds'] * 1000:>9.0f} мс, "
+              f"процесс {stats['wall_seconds'] * 1000:.0f} мс{status}")
+    frontend = imports[FRONTEND]
+    over_budget = (
+        not frontend["ok"] or frontend["loads_torch"] or frontend["import_seconds"] > args.import_budget
+    )
+    if frontend["loads_torch"]:
+        print(f"⚠️ {FRONTEND} импортирует torch")
+    if frontend["import_seconds"] > args.import_budget:
+        print(f"⚠️ {FRONTEND} импортируется дольше {args.import_budget}с")
+    if args.imports_only:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump({"imports": imports}, f, indent=2, ensure_ascii=False)
+        print(f"Результат: {args.out}")
+        sys.exit(1 if over_budget else 0)
+
+    import torch
+    import imaging
+    import model
+    from styles import SUBSTYLES
+
+    prompts = [SUBSTYLES[ref.split("/")[0]][ref.split("/")[1]] for ref in args.styles]
+    faces = []
+    for path in args.faces:
+        with open(path, "rb") as f:
+            faces.append(f.read())
+
+    started = time.perf_counter()
+    # Энкодеры не выгружаем: стоимость кодирования текста тоже меряем
+    model.load_model(
+        prompts=[],
+        unload_text_encoders=False,
+        mode=args.precision,
+        channels_last=not args.no_channels_last,
+        compile_unet=args.compile
+    )
+    load_seconds = time.perf_counter() - started
+
+    text_encode = []
+    for prompt in prompts:
+        started = time.perf_counter()
+        model.prompt_cache[prompt] = model.encode_prompt(prompt)
+        text_encode.append(time.perf_counter() - started)
+
+    items = [
+        {"prompt": prompt, "image": face, "seed": args.seed}
+        for face in faces
+        for prompt in prompts
+    ]
+    batches = [items[i:i + args.batch] for i in range(0, len(items), args.batch)]
+
+    stages = {"image_encode": [], "unet_step": [], "vae_decode": [], "jpeg_encode": [], "watermark": []}
+    batch_seconds = []
+    for number, batch in enumerate(batches, 1):
+        timings = {}
+        started = time.perf_counter()
+        results = model.render_batch(batch, steps=args.steps, timings=timings)
+        for image, _ in results:
+            encode_started = time.perf_counter()
+            jpeg = imaging.encode_jpeg(image)
+            stages["jpeg_encode"].append(time.perf_counter() - encode_started)
+            encode_started = time.perf_counter()
+            imaging.add_watermark(jpeg)
+            stages["watermark"].append(time.perf_counter() - encode_started)
+        batch_seconds.append(time.perf_counter() - started)
+        # Кодирование фото считаем на один элемент, чтобы цифры не зависели от --batch
+        stages["image_encode"].append(timings["image_encode"] / len(batch))
+        stages["unet_step"].extend(timings["unet_steps"])
+        stages["vae_decode"].append(timings["vae_decode"])
+        print(f"  батч {number}/{len(batches)}: {batch_seconds[-1]:.1f}с")
+
+    if args.profile:
+        with torch.profiler.profile(activities=[torch.profiler.ProfilerActivity.CPU]) as profiler:
+            model.render_batch(batches[0], steps=args.steps)
+        profiler.export_chrome_trace(args.profile)
+        print(f"🧾 Trace сохранён: {args.profile}")
+
+    total_seconds = sum(batch_seconds)
+    report = {
+        "config": {
+            "precision": args.precision,
+            "steps": args.steps,
+            "batch": args.batch,
+            "seed": args.seed,
+            "channels_last": not args.no_channels_last,
+            "compile": args.compile,
+            "styles": args.styles,
+            "faces": len(faces),
+            "torch": torch.__version__,
+            "torch_threads": torch.get_num_threads(),
+            "cpu": platform.processor() or platform.machine(),
+            "cpu_count": os.cpu_count(),
+        },
+        "imports": imports,
+        "load_seconds": load_seconds,
+        "load_phases": dict(model.load_timings),
+        "stages": {
+            "text_encode": summarize(text_encode),
+            **{name: summarize(values) for name, values in stages.items()},
+        },
+        "seconds_per_image": total_seconds / len(items),
+        "images_per_hour": 3600 * len(items) / total_seconds,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    with open(args.out, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+    print(f"\n📊 {len(items)} изобр., {report['seconds_per_image']:.1f}с/изобр., "
+          f"{report['images_per_hour']:.0f} изобр./час, пик RSS {report['peak_rss_mb']:.0f} МБ")
+    for name, stats in report["stages"].items():
+        print(f"  {name:<13} {stats['mean'] * 1000:>9.0f} мс (p50 {stats['p50'] * 1000:.0f}, max {stats['max'] * 1000:.0f})")
+    print(f"Результат: {args.out}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,69 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# LRU-кэш с временем жизни записей. Пишут в него только хендлеры и колбэки
+# очереди в процессе бота (процессы рендера его не видят); блокировка нужна,
+# если звать его из потоков. Если задан max_bytes, значения должны быть
+# bytes — тогда кэш ограничен ещё и суммарным размером.
+class TTLCache:
+    def __init__(self, max_items: int, ttl: float, max_bytes: int = None):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at < time.monotonic():
+                self._remove(key)
+                return default
+            self._items.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            if key in self._items:
+                self._remove(key)
+            self._items[key] = (time.monotonic() + self.ttl, value)
+            self.size += self._sizeof(value)
+            self._evict()
+
+    def pop(self, key, default=None):
+        with self._lock:
+            if key not in self._items:
+                return default
+            return self._remove(key)
+
+    def __contains__(self, key) -> bool:
+        return self.get(key) is not None
+
+    def __len__(self) -> int:
+        with self._lock:
+            self._evict()
+            return len(self._items)
+
+    def _sizeof(self, value) -> int:
+        return len(value) if self.max_bytes is not None else 0
+
+    def _remove(self, key):
+        _, value = self._items.pop(key)
+        self.size -= self._sizeof(value)
+        return value
+
+    def _evict(self):
+        now = time.monotonic()
+        for key in [key for key, (expires_at, _) in self._items.items() if expires_at < now]:
+            self._remove(key)
+        while self._items and (
+            len(self._items) > self.max_items
+            or (self.max_bytes is not None and self.size > self.max_bytes)
+        ):
+            self._remove(next(iter(self._items)))
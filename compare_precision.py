@@ -0,0 +1,122 @@
+import argparse
+import json
+import math
+import os
+import resource
+import subprocess
+import sys
+import time
+
+import numpy as np
+from PIL import Image
+
+# Сравнение режимов точности по скорости, памяти и качеству относительно fp32.
+# Каждый режим запускается в отдельном процессе, чтобы пиковая память не смешивалась.
+#
+#   python compare_precision.py --face face.jpg --modes fp32 bf16 int8
+#
+DEFAULT_STYLES = [
+    "female_portrait/warm_sweater",
+    "male_portrait/street_portrait",
+    "new_year/snow",
+    "cyberpunk/neon_rain",
+]
+
+
+def run_mode(args):
+    import model
+    from styles import SUBSTYLES
+
+    prompts = {ref: SUBSTYLES[ref.split("/")[0]][ref.split("/")[1]] for ref in args.styles}
+    started = time.perf_counter()
+    model.load_model(
+        prompts=list(prompts.values()),
+        mode=args.child,
+        channels_last=not args.no_channels_last,
+        compile_unet=args.compile
+    )
+    load_seconds = time.perf_counter() - started
+
+    with open(args.face, "rb") as f:
+        face = f.read()
+    out_dir = os.path.join(args.out, args.child)
+    os.makedirs(out_dir, exist_ok=True)
+    latencies = {}
+    for ref, prompt in prompts.items():
+        started = time.perf_counter()
+        image, _ = model.render(prompt, face, seed=args.seed, steps=args.steps)
+        latencies[ref] = time.perf_counter() - started
+        image.save(os.path.join(out_dir, ref.replace("/", "__") + ".png"))
+        print(f"  {args.child} {ref}: {latencies[ref]:.1f}с")
+
+    report = {
+        "mode": args.child,
+        "load_seconds": load_seconds,
+        "latency_seconds": latencies,
+        "mean_latency_seconds": sum(latencies.values()) / len(latencies),
+        # ru_maxrss в Linux — в килобайтах
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+    with open(os.path.join(out_dir, "report.json"), "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+def psnr(a_path: str, b_path: str) -> float:
+    a = np.asarray(Image.open(a_path).convert("RGB"), dtype=np.float64)
+    b = np.asarray(Image.open(b_path).convert("RGB"), dtype=np.float64)
+    mse = np.mean((a - b) ** 2)
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def compare(args):
+    reports = {}
+    for mode in args.modes:
+        print(f"▶️ {mode}")
+        cmd = [sys.executable, os.path.abspath(__file__), "--child", mode] + sys.argv[1:]
+        subprocess.run(cmd, check=True)
+        with open(os.path.join(args.out, mode, "report.json"), encoding="utf-8") as f:
+            reports[mode] = json.load(f)
+
+    reference = os.path.join(args.out, "fp32")
+    for mode, report in reports.items():
+        if mode == "fp32" or not os.path.isdir(reference):
+            continue
+        scores = [
+            psnr(os.path.join(reference, name), os.path.join(args.out, mode, name))
+            for name in (ref.replace("/", "__") + ".png" for ref in args.styles)
+        ]
+        report["mean_psnr_vs_fp32"] = sum(scores) / len(scores)
+
+    with open(os.path.join(args.out, "summary.json"), "w", encoding="utf-8") as f:
+        json.dump(reports, f, indent=2, ensure_ascii=False)
+
+    print(f"\n{'режим':<6} {'загрузка':>9} {'рендер':>8} {'RSS, МБ':>9} {'PSNR':>7}")
+    for mode, report in reports.items():
+        quality = report.get("mean_psnr_vs_fp32")
+        quality = "—" if quality is None else f"{quality:.1f}"
+        print(
+            f"{mode:<6} {report['load_seconds']:>8.1f}с {report['mean_latency_seconds']:>7.1f}с "
+            f"{report['peak_rss_mb']:>9.0f} {quality:>7}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Сравнение fp32 / bf16 / int8 для SDXL на CPU")
+    parser.add_argument("--face", required=True, help="фото лица для IP-Adapter")
+    parser.add_argument("--modes", nargs="+", default=["fp32", "bf16", "int8"])
+    parser.add_argument("--styles", nargs="+", default=DEFAULT_STYLES, help="main_style/substyle")
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--out", default="precision_report")
+    parser.add_argument("--no-channels-last", action="store_true")
+    parser.add_argument("--compile", action="store_true", help="torch.compile для UNet")
+    parser.add_argument("--child", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        run_mode(args)
+    else:
+        compare(args)
+
+
+if __name__ == "__main__":
+    main()
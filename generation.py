@@ -0,0 +1,211 @@
+import asyncio
+import itertools
+import math
+import random
+import secrets
+import time
+from dataclasses import dataclass, field
+import metrics
+
+# === ОЧЕРЕДЬ ГЕНЕРАЦИЙ ===
+_job_ids = itertools.count(1)
+
+
+@dataclass(eq=False)
+class GenerationJob:
+    user_id: int
+    chat_id: int
+    message_id: int
+    main_style: str
+    substyle: str
+    photo_key: str
+    # file_id фото в Telegram: по нему фото скачивается заново при восстановлении задачи
+    photo_id: str = None
+    # Либо байты фото, либо уже посчитанные эмбеддинги IP-Adapter (safetensors, см. model.dump_image_embeds)
+    image: bytes = None
+    image_embeds: bytes = None
+    seed: int = field(default_factory=lambda: random.randrange(2 ** 32))
+    # Тариф рендера выбирается до инференса: paid — генерация уже списана с баланса
+    tier: str = "preview"
+    paid: bool = False
+    # Сообщение с превью прогресса и время его последнего обновления
+    progress_message_id: int = None
+    progress_at: float = 0.0
+    # Идентификатор результата для кнопки оплаты: в отличие от id, не повторяется после перезапуска
+    render_id: str = field(default_factory=lambda: secrets.token_hex(4))
+    id: int = field(default_factory=lambda: next(_job_ids))
+    created_at: float = field(default_factory=time.monotonic)
+
+
+# Ограниченная очередь рендеров: хендлеры бота только ставят задачи,
+# а сам пайплайн крутится в процессах рендера и не блокирует event loop.
+# Задачи, пришедшие почти одновременно, воркер собирает в батч за batch_window
+# секунд (не больше batch_max) и рендерит одним вызовом await render_batch(jobs, progress).
+# В один батч попадают только задачи одного тарифа: у них общие шаги и разрешение.
+# progress(index, step, total, preview) можно звать из любого потока — обновления
+# передаются в on_progress в event loop, не больше одного одновременно на задачу.
+# workers — сколько батчей рендерится одновременно, по числу процессов рендера.
+# Оплаченные задачи встают в очередь перед бесплатными.
+class GenerationQueue:
+    def __init__(self, render_batch, on_start, on_done, on_error, on_progress=None,
+                 workers: int = 1, maxsize: int = 20, avg_render_time: float = 45.0,
+                 batch_max: int = 1, batch_window: float = 0.5):
+        self.render_batch = render_batch
+        self.on_start = on_start
+        self.on_done = on_done
+        self.on_error = on_error
+        self.on_progress = on_progress
+        self._progress_tasks = {}
+        self.workers = workers
+        self.maxsize = maxsize
+        self.pending = []
+        # Все задачи от submit до ответа пользователю: и в очереди, и в рендере
+        self.in_flight = {}
+        self._user_rates = {}
+        self._wakeup = asyncio.Event()
+        self.active = 0
+        # Батчи, которые уже собираются или рендерятся: к ним новая задача не присоединится
+        self.rendering = 0
+        self.avg_render_time = avg_render_time
+        self.batch_max = batch_max
+        self.batch_window = batch_window
+        self._tasks = []
+        metrics.queue_pending.set_function(lambda: len(self.pending))
+        metrics.queue_rendering.set_function(lambda: self.active)
+
+    def start(self):
+        for _ in range(self.workers):
+            self._tasks.append(asyncio.create_task(self._worker()))
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks.clear()
+
+    def submit(self, job: GenerationJob) -> int:
+        # asyncio.QueueFull пробрасывается наружу — бот отвечает «очередь переполнена»
+        if len(self.pending) >= self.maxsize:
+            raise asyncio.QueueFull
+        if job.paid:
+            index = next((i for i, queued in enumerate(self.pending) if not queued.paid), len(self.pending))
+            self.pending.insert(index, job)
+        else:
+            self.pending.append(job)
+        self.in_flight[job.id] = job
+        self._user_rates.setdefault(job.user_id, metrics.RateMeter(60.0)).add()
+        # Пользователи без задач за последнюю минуту счётчиков не держат
+        for user_id in [user_id for user_id, meter in self._user_rates.items() if not meter.rate()]:
+            del self._user_rates[user_id]
+        self._wakeup.set()
+        return self.position(job)
+
+    def position(self, job: GenerationJob) -> int:
+        return self.pending.index(job) + 1
+
+    def user_jobs(self, user_id: int) -> int:
+        return sum(1 for job in self.in_flight.values() if job.user_id == user_id)
+
+    def user_rate(self, user_id: int) -> int:
+        # Сколько задач пользователь поставил за последнюю минуту
+        meter = self._user_rates.get(user_id)
+        return meter.rate() if meter else 0
+
+    def find(self, user_id: int, photo_key: str, main_style: str, substyle: str):
+        for job in self.in_flight.values():
+            if (job.user_id, job.photo_key, job.main_style, job.substyle) == (user_id, photo_key, main_style, substyle):
+                return job
+        return None
+
+    def rounds(self, position: int) -> int:
+        # Сколько «раундов» (по батчу на воркер) пройдёт, пока задача не будет готова.
+        # Идущий батч занимает своего воркера целый раунд, задачи из очереди —
+        # ceil(position / batch_max) новых батчей
+        return math.ceil((self.rendering + math.ceil(position / self.batch_max)) / self.workers)
+
+    def eta(self, position: int) -> int:
+        return int(self.rounds(position) * self.avg_render_time)
+
+    async def _next_batch(self) -> list:
+        while not self.pending:
+            self._wakeup.clear()
+            await self._wakeup.wait()
+        # Задачи забираем из pending сразу, чтобы другой воркер их не взял
+        batch = [self.pending.pop(0)]
+        self.active += 1
+        self.rendering += 1
+        deadline = time.monotonic() + self.batch_window
+        while True:
+            for job in [job for job in self.pending if job.tier == batch[0].tier]:
+                if len(batch) >= self.batch_max:
+                    break
+                self.pending.remove(job)
+                self.active += 1
+                batch.append(job)
+            remaining = deadline - time.monotonic()
+            if len(batch) >= self.batch_max or remaining <= 0:
+                return batch
+            await asyncio.sleep(min(0.05, remaining))
+
+    async def _worker(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = await self._next_batch()
+            started = time.monotonic()
+            try:
+                for job in batch:
+                    metrics.queue_wait_seconds.observe(started - job.created_at, tier=job.tier)
+                    await self._notify(self.on_start, job, started - job.created_at)
+                progress = self._progress_bridge(loop, batch)
+                results = await self.render_batch(batch, progress)
+            except Exception as e:
+                await self._drain_progress(batch)
+                for job in batch:
+                    await self._notify(self.on_error, job, e)
+            else:
+                elapsed = time.monotonic() - started
+                self.avg_render_time = 0.8 * self.avg_render_time + 0.2 * elapsed
+                metrics.render_batch_size.observe(len(batch))
+                metrics.images_per_minute.add(len(batch))
+                for job in batch:
+                    metrics.images_rendered.inc(tier=job.tier, paid=str(job.paid).lower())
+                    metrics.render_seconds.observe(
+                        elapsed, main_style=job.main_style, substyle=job.substyle, tier=job.tier
+                    )
+                print(
+                    f"📦 Батч из {len(batch)} ({batch[0].tier}) за {elapsed:.1f}с, "
+                    f"{metrics.images_per_minute.rate()} изобр./мин"
+                )
+                await self._drain_progress(batch)
+                for job, result in zip(batch, results):
+                    await self._notify(self.on_done, job, result)
+            finally:
+                self.active -= len(batch)
+                self.rendering -= 1
+                for job in batch:
+                    self.in_flight.pop(job.id, None)
+
+    def _progress_bridge(self, loop, batch):
+        def progress(index, step, total, preview):
+            loop.call_soon_threadsafe(self._start_progress, batch[index], step, total, preview)
+        return progress
+
+    def _start_progress(self, job, step, total, preview):
+        # Пока предыдущее обновление не ушло в Telegram, новые просто пропускаем
+        if self.on_progress is None or job.id in self._progress_tasks:
+            return
+        task = asyncio.create_task(self._notify(self.on_progress, job, (step, total, preview)))
+        self._progress_tasks[job.id] = task
+        task.add_done_callback(lambda _: self._progress_tasks.pop(job.id, None))
+
+    async def _drain_progress(self, batch):
+        # Результат отправляем только после последнего превью, чтобы не перепутать порядок
+        tasks = [self._progress_tasks[job.id] for job in batch if job.id in self._progress_tasks]
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    @staticmethod
+    async def _notify(callback, job, arg):
+        try:
+            await callback(job, arg)
+        except Exception as e:
+            print(f"⚠️ Ошибка обработчика задачи #{job.id}: {e}")
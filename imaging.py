@@ -0,0 +1,36 @@
+from io import BytesIO
+from PIL import Image, ImageDraw, ImageFont
+
+# === ИЗОБРАЖЕНИЯ ===
+# Всё в памяти: фото приходит байтами из Telegram и уходит байтами обратно,
+# без временных файлов на диске.
+
+
+def decode_image(data: bytes) -> Image.Image:
+    with Image.open(BytesIO(data)) as image:
+        return image.convert("RGB")
+
+
+def encode_jpeg(image: Image.Image, quality: int = 95) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, "JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def add_watermark(data: bytes) -> bytes:
+    image = decode_image(data)
+    image.thumbnail((1280, 720), Image.Resampling.LANCZOS)
+    draw = ImageDraw.Draw(image)
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", 30)
+    except:
+        font = ImageFont.load_default()
+    text = "PREVIEW @lumifyaibot"
+    bbox = draw.textbbox((0, 0), text, font=font)
+    text_width = bbox[2] - bbox[0]
+    text_height = bbox[3] - bbox[1]
+    x = image.width - text_width - 20
+    y = image.height - text_height - 20
+    draw.rectangle([x-5, y-5, x+text_width+5, y+text_height+5], fill=(0, 0, 0, 128))
+    draw.text((x, y), text, fill=(255, 255, 255), font=font)
+    return encode_jpeg(image, quality=85)
@@ -0,0 +1,185 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+# === МЕТРИКИ ===
+# Простые счётчики, гауджи и гистограммы в духе Prometheus, без внешних зависимостей.
+# Каждая метрика регистрируется в REGISTRY; exposition() отдаёт их все
+# в текстовом формате Prometheus для /metrics.
+REGISTRY = []
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(key, *extra) -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in key + extra]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    type = "counter"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def inc(self, value: float = 1, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+    def samples(self) -> list:
+        with self._lock:
+            return [f"{self.name}{_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Gauge:
+    type = "gauge"
+
+    def __init__(self, name: str, help: str):
+        self.name = name
+        self.help = help
+        self.values = {}
+        self.function = None
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def set(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            self.values[key] = value
+
+    def set_function(self, function):
+        # Значение без меток, которое считается в момент запроса /metrics
+        self.function = function
+
+    def clear(self):
+        with self._lock:
+            self.values.clear()
+
+    def samples(self) -> list:
+        if self.function is not None:
+            return [f"{self.name} {self.function()}"]
+        with self._lock:
+            return [f"{self.name}{_labels(key)} {value}" for key, value in self.values.items()]
+
+
+class Histogram:
+    type = "histogram"
+
+    def __init__(self, name: str, help: str, buckets):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(sorted(buckets))
+        self.values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def observe(self, value: float, **labels):
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counts, total, count = self.values.get(key, ([0] * len(self.buckets), 0.0, 0))
+            index = bisect.bisect_left(self.buckets, value)
+            if index < len(self.buckets):
+                counts[index] += 1
+            self.values[key] = (counts, total + value, count + 1)
+
+    def samples(self) -> list:
+        lines = []
+        with self._lock:
+            for key, (counts, total, count) in self.values.items():
+                # В формате Prometheus бакеты накопительные
+                cumulative = 0
+                for bucket, bucket_count in zip(self.buckets, counts):
+                    cumulative += bucket_count
+                    lines.append(f"{self.name}_bucket{_labels(key, ('le', bucket))} {cumulative}")
+                lines.append(f"{self.name}_bucket{_labels(key, ('le', '+Inf'))} {count}")
+                lines.append(f"{self.name}_sum{_labels(key)} {total}")
+                lines.append(f"{self.name}_count{_labels(key)} {count}")
+        return lines
+
+
+class RateMeter:
+    # Скользящее окно: сколько событий было за последние window секунд
+    def __init__(self, window: float = 60.0):
+        self.window = window
+        self.events = deque()
+        self._lock = threading.Lock()
+
+    def add(self, count: int = 1):
+        now = time.monotonic()
+        with self._lock:
+            self.events.extend([now] * count)
+            self._trim(now)
+
+    def rate(self) -> int:
+        with self._lock:
+            self._trim(time.monotonic())
+            return len(self.events)
+
+    def _trim(self, now: float):
+        while self.events and self.events[0] < now - self.window:
+            self.events.popleft()
+
+
+def exposition() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.append(f"# HELP {metric.name} {metric.help}")
+        lines.append(f"# TYPE {metric.name} {metric.type}")
+        lines.extend(metric.samples())
+    return "\n".join(lines) + "\n"
+
+
+def process_memory(pid="self") -> dict:
+    # RSS и PSS процесса в байтах. У форкнутых воркеров RSS включает общие
+    # страницы с весами, поэтому честную долю каждого показывает PSS
+    memory = {}
+    try:
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                name, _, value = line.partition(":")
+                if name in ("Rss", "Pss"):
+                    memory[name.lower()] = int(value.split()[0]) * 1024
+    except OSError:
+        pass
+    return memory
+
+
+render_batch_size = Histogram(
+    "avatar_render_batch_size", "Сколько задач рендерится за один проход UNet",
+    buckets=(1, 2, 3, 4, 6, 8)
+)
+images_rendered = Counter("avatar_images_rendered_total", "Сколько изображений отрендерено, по тарифу и оплате")
+images_per_minute = RateMeter(60.0)
+images_last_minute = Gauge("avatar_images_per_minute", "Сколько изображений отрендерено за последние 60 секунд")
+images_last_minute.set_function(images_per_minute.rate)
+render_seconds = Histogram(
+    "avatar_render_seconds", "Время рендера задачи по стилям и тарифам",
+    buckets=(5, 10, 20, 30, 45, 60, 90, 120, 180, 300)
+)
+render_stage_seconds = Histogram(
+    "avatar_render_stage_seconds", "Длительность стадий рендера (unet_step — один шаг)",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2, 5, 10, 30)
+)
+queue_wait_seconds = Histogram(
+    "avatar_queue_wait_seconds", "Сколько задача ждала в очереди до начала рендера",
+    buckets=(1, 5, 15, 30, 60, 120, 300, 600)
+)
+queue_pending = Gauge("avatar_queue_pending", "Задач в очереди")
+queue_rendering = Gauge("avatar_queue_rendering", "Задач в рендере прямо сейчас")
+generations = Counter("avatar_generations_total", "Генерации по стилям: requested / paid / preview")
+model_ready = Gauge("avatar_model_ready", "1, если модель загружена и принимает задачи")
+process_memory_bytes = Gauge("avatar_process_memory_bytes", "Память процессов бота и рендера")
+torch_threads = Gauge("avatar_torch_threads", "Потоков torch у каждого воркера рендера")
+telegram_request_seconds = Histogram(
+    "avatar_telegram_request_seconds", "Время запросов к Bot API (кроме getUpdates)",
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+)
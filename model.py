@@ -0,0 +1,318 @@
+import hashlib
+from contextlib import contextmanager
+import os
+import random
+import threading
+import time
+from PIL import Image
+import torch
+from diffusers import DPMSolverMultistepScheduler, StableDiffusionXLPipeline
+from safetensors.torch import load, load_file, save, save_file
+from imaging import decode_image, encode_jpeg
+
+# === МОДЕЛЬ ===
+MODEL_ID = "stabilityai/stable-diffusion-xl-base-1.0"
+NEGATIVE_PROMPT = "blurry, distorted face, extra fingers, bad anatomy, low quality, text, watermark"
+EMBEDS_DIR = "embeds_cache"
+PRECISIONS = ("fp32", "bf16", "int8")
+# Планировщики для тарифов рендера: default — родной планировщик модели,
+# dpmpp — DPM-Solver++ с сигмами Карраса, даёт приличный результат за 10–15 шагов
+SCHEDULERS = {
+    "default": (None, {}),
+    "dpmpp": (DPMSolverMultistepScheduler, {"algorithm_type": "dpmsolver++", "use_karras_sigmas": True}),
+}
+# Линейное приближение VAE-декодера SDXL: 4 канала латента → RGB.
+# Для превью прогресса этого хватает, а стоит на порядки дешевле настоящего VAE.
+LATENT_RGB_FACTORS = (
+    (0.3651, 0.4232, 0.4341),
+    (-0.2533, -0.0042, 0.1068),
+    (0.1076, 0.1111, -0.0362),
+    (-0.3165, -0.2492, -0.2188),
+)
+LATENT_RGB_BIAS = (0.1084, -0.0175, -0.0011)
+EMBED_KEYS = ("prompt_embeds", "negative_prompt_embeds", "pooled_prompt_embeds", "negative_pooled_prompt_embeds")
+
+pipe = None
+prompt_cache = {}
+# cold → loading → warming → ready (или failed)
+state = "cold"
+precision = "fp32"
+load_timings = {}
+_load_lock = threading.Lock()
+_local = threading.local()
+
+
+def load_model(threads: int = None, prompts=(), unload_text_encoders: bool = True,
+               mode: str = "fp32", channels_last: bool = True, compile_unet: bool = False,
+               warm: bool = True):
+    global pipe, state, precision
+    with _load_lock:
+        if pipe is not None:
+            return
+        if mode not in PRECISIONS:
+            raise ValueError(f"Неизвестный режим точности: {mode}")
+        print(f"🔄 Загружаем модель SDXL + IP-Adapter ({mode})...")
+        state = "loading"
+        precision = mode
+        timings = {}
+        started = time.perf_counter()
+        if threads:
+            torch.set_num_threads(threads)
+        try:
+            # low_cpu_mem_usage: веса читаются прямо из mmap-нутых safetensors,
+            # без промежуточной копии state_dict в памяти
+            with _phase(timings, "from_pretrained"):
+                loaded = StableDiffusionXLPipeline.from_pretrained(
+                    MODEL_ID,
+                    torch_dtype=torch.bfloat16 if mode == "bf16" else torch.float32,
+                    use_safetensors=True,
+                    low_cpu_mem_usage=True
+                ).to("cpu")
+            with _phase(timings, "ip_adapter"):
+                loaded.load_ip_adapter(
+                    "h94/IP-Adapter",
+                    subfolder="sdxl",
+                    weight_name="ip-adapter_sdxl.bin"
+                )
+                loaded.set_ip_adapter_scale(0.7)
+            with _phase(timings, "optimize"):
+                optimize_pipeline(loaded, mode, channels_last, compile_unet)
+            pipe = loaded
+            with _phase(timings, "prompt_cache"):
+                build_prompt_cache(prompts)
+            if unload_text_encoders:
+                # Все промпты каталога уже закодированы — CLIP-энкодеры больше не нужны
+                pipe.text_encoder = None
+                pipe.text_encoder_2 = None
+                print("🧹 Текстовые энкодеры выгружены")
+            if warm:
+                state = "warming"
+                with _phase(timings, "warmup"):
+                    warmup()
+        except Exception as e:
+            pipe = None
+            state = "failed"
+            print(f"❌ Ошибка загрузки модели: {e}")
+            raise
+        state = "ready"
+        load_timings.update(timings)
+        phases = ", ".join(f"{name} {seconds:.1f}с" for name, seconds in timings.items())
+        print(f"✅ Модель загружена за {time.perf_counter() - started:.1f}с ({phases})")
+
+
+def optimize_pipeline(target, mode: str, channels_last: bool, compile_unet: bool):
+    if mode == "int8":
+        # Динамическая квантизация: веса Linear хранятся в int8, активации
+        # квантуются на лету. Свёртки UNet и VAE остаются во fp32.
+        modules = [target.unet, target.text_encoder, target.text_encoder_2]
+        for module in modules:
+            torch.ao.quantization.quantize_dynamic(module, {torch.nn.Linear}, dtype=torch.qint8, inplace=True)
+    if channels_last:
+        target.unet.to(memory_format=torch.channels_last)
+        target.vae.to(memory_format=torch.channels_last)
+    if compile_unet:
+        target.unet = torch.compile(target.unet)
+
+
+def autocast():
+    # В bf16-режиме веса уже bf16, а autocast подхватывает операции,
+    # которые иначе ушли бы во fp32 (например, кэшированные эмбеддинги)
+    return torch.autocast("cpu", dtype=torch.bfloat16, enabled=precision == "bf16")
+
+
+@contextmanager
+def _phase(timings: dict, name: str):
+    started = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - started
+    print(f"⏱️ {name}: {timings[name]:.1f}с")
+
+
+def warmup():
+    # Короткий прогон на маленьком разрешении: инициализирует ленивые части
+    # (oneDNN-примитивы, аллокатор, attention-процессоры IP-Adapter) до первого пользователя
+    prompt = next(iter(prompt_cache), "portrait photo")
+    with torch.no_grad(), autocast():
+        pipe(
+            **prompt_embeds(prompt),
+            ip_adapter_image=Image.new("RGB", (224, 224)),
+            num_inference_steps=2,
+            height=512,
+            width=512,
+            guidance_scale=7.5
+        )
+
+
+# === КЭШ ЭМБЕДДИНГОВ ПРОМПТОВ ===
+def _model_hash() -> str:
+    h = hashlib.sha256(MODEL_ID.encode())
+    for encoder in (pipe.text_encoder, pipe.text_encoder_2):
+        h.update(encoder.config.to_json_string().encode())
+    # int8-энкодеры дают немного другие эмбеддинги, чем fp32 с тем же dtype
+    h.update(f"{precision}|{pipe.text_encoder_2.dtype}".encode())
+    return h.hexdigest()[:16]
+
+def _prompt_hash(prompt: str) -> str:
+    return hashlib.sha256(f"{prompt}\n{NEGATIVE_PROMPT}".encode()).hexdigest()[:16]
+
+def encode_prompt(prompt: str) -> dict:
+    with torch.no_grad():
+        embeds = pipe.encode_prompt(
+            prompt=prompt,
+            device="cpu",
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True,
+            negative_prompt=NEGATIVE_PROMPT
+        )
+    # encode_prompt возвращает тензоры в порядке EMBED_KEYS
+    return {key: tensor.contiguous() for key, tensor in zip(EMBED_KEYS, embeds)}
+
+def build_prompt_cache(prompts):
+    cache_dir = os.path.join(EMBEDS_DIR, _model_hash())
+    os.makedirs(cache_dir, exist_ok=True)
+    encoded = 0
+    for prompt in prompts:
+        if prompt in prompt_cache:
+            continue
+        path = os.path.join(cache_dir, f"{_prompt_hash(prompt)}.safetensors")
+        if os.path.exists(path):
+            prompt_cache[prompt] = load_file(path)
+            continue
+        prompt_cache[prompt] = encode_prompt(prompt)
+        save_file(prompt_cache[prompt], path)
+        encoded += 1
+    print(f"🧠 Эмбеддинги промптов: {len(prompt_cache)} в кэше, {encoded} посчитано заново")
+
+def prompt_embeds(prompt: str) -> dict:
+    embeds = prompt_cache.get(prompt)
+    if embeds is None:
+        if pipe.text_encoder is None:
+            raise KeyError("Промпта нет в кэше эмбеддингов, а текстовые энкодеры выгружены")
+        embeds = prompt_cache[prompt] = encode_prompt(prompt)
+    return embeds
+
+def worker_pipe(scheduler: str = None):
+    # Планировщик хранит состояние между шагами, поэтому у каждого потока-воркера
+    # свой экземпляр пайплайна и свои планировщики; UNet, VAE и энкодеры общие.
+    local_pipe = getattr(_local, "pipe", None)
+    if local_pipe is None:
+        _local.schedulers = {}
+        local_pipe = StableDiffusionXLPipeline.from_pipe(pipe, scheduler=_scheduler("default"))
+        _local.pipe = local_pipe
+    if scheduler is not None:
+        local_pipe.scheduler = _scheduler(scheduler)
+    return local_pipe
+
+
+def _scheduler(name: str):
+    schedulers = _local.schedulers
+    if name not in schedulers:
+        cls, options = SCHEDULERS[name]
+        cls = cls or pipe.scheduler.__class__
+        schedulers[name] = cls.from_config(pipe.scheduler.config, **options)
+    return schedulers[name]
+
+
+def encode_image(face: Image.Image) -> list:
+    # Эмбеддинги CLIP vision для IP-Adapter, уже с негативной половиной для CFG:
+    # в таком виде их можно передавать обратно в ip_adapter_image_embeds
+    with torch.no_grad(), autocast():
+        return worker_pipe().prepare_ip_adapter_image_embeds(
+            ip_adapter_image=face,
+            ip_adapter_image_embeds=None,
+            device="cpu",
+            num_images_per_prompt=1,
+            do_classifier_free_guidance=True
+        )
+
+
+def dump_image_embeds(image_embeds: list) -> bytes:
+    # Между процессами эмбеддинги фото ходят байтами safetensors:
+    # фронтенд хранит их в кэше, не импортируя torch
+    return save({str(index): tensor.contiguous() for index, tensor in enumerate(image_embeds)})
+
+
+def load_image_embeds(data: bytes) -> list:
+    tensors = load(data)
+    return [tensors[str(index)] for index in range(len(tensors))]
+
+
+def latent_previews(latents) -> list:
+    with torch.no_grad():
+        factors = torch.tensor(LATENT_RGB_FACTORS)
+        bias = torch.tensor(LATENT_RGB_BIAS)
+        rgb = torch.einsum("bchw,cr->bhwr", latents.float(), factors) + bias
+        pixels = ((rgb + 1) / 2).clamp(0, 1).mul(255).to(torch.uint8).numpy()
+    previews = []
+    for array in pixels:
+        image = Image.fromarray(array)
+        # Латент в 8 раз меньше картинки: 128 px → 256 px, чтобы превью было видно
+        image = image.resize((image.width * 2, image.height * 2), Image.Resampling.BILINEAR)
+        previews.append(encode_jpeg(image, quality=70))
+    return previews
+
+
+def render_batch(items: list, steps: int = 30, width: int = 1024, height: int = 1024,
+                 guidance_scale: float = 7.5, scheduler: str = "default",
+                 progress=None, preview_every: int = 0, timings: dict = None) -> list:
+    # items: [{"prompt", "image" (байты) | "image_embeds", "seed"}, ...] — один проход
+    # UNet на всех; у каждого элемента свой генератор, поэтому результат
+    # не зависит от того, с кем задача попала в батч.
+    # progress(index, step, total, jpeg) вызывается каждые preview_every шагов.
+    # В timings, если передан, пишутся длительности стадий в секундах.
+    timings = {} if timings is None else timings
+    started = time.perf_counter()
+    image_embeds = [
+        item["image_embeds"] if item.get("image_embeds") is not None else encode_image(decode_image(item["image"]))
+        for item in items
+    ]
+    timings["image_encode"] = time.perf_counter() - started
+    started = time.perf_counter()
+    prompts = [prompt_embeds(item["prompt"]) for item in items]
+    timings["text_encode"] = time.perf_counter() - started
+    batched = {key: torch.cat([embeds[key] for embeds in prompts]) for key in EMBED_KEYS}
+    # prepare_ip_adapter_image_embeds делит тензор пополам на негатив/позитив,
+    # поэтому сначала идут все негативные половины, потом все позитивные
+    ip_embeds = []
+    for per_adapter in zip(*image_embeds):
+        negatives, positives = zip(*(embeds.chunk(2) for embeds in per_adapter))
+        ip_embeds.append(torch.cat(negatives + positives))
+    generators = [
+        torch.Generator("cpu").manual_seed(item["seed"] if item.get("seed") is not None else random.randrange(2 ** 32))
+        for item in items
+    ]
+
+    step_ends = []
+
+    def on_step_end(pipeline, step, timestep, callback_kwargs):
+        step_ends.append(time.perf_counter())
+        done = step + 1
+        if progress and preview_every and done % preview_every == 0 and done < steps:
+            for index, preview in enumerate(latent_previews(callback_kwargs["latents"])):
+                progress(index, done, steps, preview)
+        return callback_kwargs
+
+    started = time.perf_counter()
+    with autocast():
+        images = worker_pipe(scheduler)(
+            **batched,
+            ip_adapter_image_embeds=ip_embeds,
+            num_inference_steps=steps,
+            width=width,
+            height=height,
+            guidance_scale=guidance_scale,
+            generator=generators,
+            callback_on_step_end=on_step_end
+        ).images
+    finished = time.perf_counter()
+    # Первый шаг включает подготовку латентов и таймстепов, всё после
+    # последнего шага — декодирование VAE и перевод в PIL
+    timings["unet_steps"] = [end - start for start, end in zip([started] + step_ends, step_ends)]
+    timings["vae_decode"] = finished - (step_ends[-1] if step_ends else started)
+    return list(zip(images, image_embeds))
+
+
+def render(prompt: str, image: bytes = None, image_embeds: list = None,
+           seed: int = None, steps: int = 30):
+    item = {"prompt": prompt, "image": image, "image_embeds": image_embeds, "seed": seed}
+    return render_batch([item], steps)[0]
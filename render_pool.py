@@ -0,0 +1,359 @@
+import asyncio
+import gc
+import itertools
+import multiprocessing
+import os
+import queue
+import signal
+import subprocess
+import sys
+import threading
+import time
+from multiprocessing.connection import Connection, wait
+import metrics
+
+# === ПУЛ ПРОЦЕССОВ РЕНДЕРА ===
+# Бот не импортирует torch: модель живёт в отдельном процессе-хосте.
+# Хост один раз загружает веса и форкает из себя воркеры — страницы с весами
+# у них общие (copy-on-write, инференс их не пишет), так что N воркеров
+# не держат N копий SDXL.
+#
+#   бот ◀──socketpair──▶ хост ──inbox──▶ воркеры (fork от хоста)
+#                        хост ◀─outbox── воркеры
+#   события: state / warmed / taken / progress / done / error / worker_died / stats
+# Хост запускается как отдельная программа (python render_pool.py), а не через
+# multiprocessing spawn: тот заново выполнил бы в хосте весь bot_local.
+# С ботом хост говорит через Connection поверх socketpair, с воркерами — через
+# очереди multiprocessing, и перекладывает сообщения между ними.
+# Перезапуск упавшего хоста: пауза удваивается с каждой неудачей подряд
+RESTART_DELAY = 10.0
+RESTART_MAX_DELAY = 300.0
+WORKER_RESTART_DELAY = 1.0
+# Дедлайн батча после готовности пула: запас плюс время на шаг UNet для каждой картинки.
+# Не уложился — значит, воркер завис или событие потерялось, и хост перезапускается
+RENDER_TIMEOUT = 120.0
+STEP_TIMEOUT = 10.0
+# Как часто хост присылает память процессов рендера для /metrics
+STATS_INTERVAL = 15.0
+
+
+class RenderError(Exception):
+    pass
+
+
+class RenderPool:
+    def __init__(self, workers: int, load_options: dict):
+        self.workers = workers
+        self.load_options = load_options
+        # cold → loading → ready (или failed), как model.state, но с той стороны процесса.
+        # ready — когда хотя бы один воркер прогрелся и готов рендерить
+        self.state = "cold"
+        self._ready = asyncio.Event()
+        self._failures = 0
+        self.load_timings = {}
+        self.process = None
+        self._connection = None
+        # batch_id → [future, progress, pid воркера, который взял батч]
+        self._batches = {}
+        self._ids = itertools.count(1)
+        self._stopping = False
+        self._loop = None
+
+    def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopping = False
+        self._set_state("loading")
+        # Соединение каждый раз новое: от упавшего хоста в нём могли остаться обрывки сообщений
+        self._connection, host_end = multiprocessing.Pipe()
+        # Своя группа процессов: при зависании хост убивается вместе с воркерами
+        self.process = subprocess.Popen(
+            [sys.executable, os.path.abspath(__file__), str(host_end.fileno())],
+            pass_fds=(host_end.fileno(),), start_new_session=True
+        )
+        host_end.close()
+        self._connection.send((self.workers, self.load_options))
+        threading.Thread(
+            target=self._read_events, args=(self.process, self._connection), name="render-events", daemon=True
+        ).start()
+
+    async def stop(self):
+        self._stopping = True
+        if self.process is None:
+            return
+        # Воркеры доделывают текущие батчи и выходят по None
+        try:
+            for _ in range(self.workers):
+                self._connection.send(None)
+            await asyncio.to_thread(self.process.wait, 30)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.terminate()
+        self._connection.close()
+        self._fail_batches(None, "Пул рендера остановлен")
+
+    async def render(self, items: list, options: dict, progress=None) -> list:
+        # items — как в model.render_batch, только image_embeds в байтах.
+        # Возвращает [(jpeg, image_embeds в байтах), ...]
+        if self.process is None or self._stopping:
+            raise RenderError("Пул рендера не запущен")
+        if self.state == "failed":
+            raise RenderError("Процесс рендера перезапускается")
+        batch_id = next(self._ids)
+        future = self._loop.create_future()
+        self._batches[batch_id] = [future, progress, None]
+        try:
+            self._connection.send((batch_id, items, options))
+        except OSError as e:
+            self._batches.pop(batch_id)
+            raise RenderError(f"Процесс рендера недоступен: {e}")
+        timeout = RENDER_TIMEOUT + STEP_TIMEOUT * options.get("steps", 30) * len(items)
+        try:
+            # Пока модель грузится, дедлайн не идёт: батч ждёт в очереди хоста
+            ready = asyncio.ensure_future(self._ready.wait())
+            try:
+                await asyncio.wait([future, ready], return_when=asyncio.FIRST_COMPLETED)
+            finally:
+                ready.cancel()
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            print(f"⏰ Батч {batch_id} не отрендерился за {timeout:.0f}с — перезапускаю процесс рендера")
+            self._set_state("failed")
+            self._kill_host()
+            raise RenderError("Рендер не уложился в отведённое время")
+        finally:
+            self._batches.pop(batch_id, None)
+
+    def _read_events(self, process, connection):
+        # Конец соединения — хост завершился (или его остановили мы сами)
+        while True:
+            try:
+                event = connection.recv()
+            except (EOFError, OSError):
+                break
+            self._loop.call_soon_threadsafe(self._dispatch, *event)
+        exitcode = process.wait()
+        if not self._stopping:
+            self._loop.call_soon_threadsafe(self._host_exited, exitcode)
+
+    def _dispatch(self, kind, *args):
+        if kind == "state":
+            state, timings = args
+            self._set_state(state)
+            self.load_timings.update(timings)
+            return
+        if kind == "warmed":
+            self.load_timings.setdefault("warmup", args[1])
+            if self.state == "loading":
+                self._set_state("ready")
+                self._failures = 0
+                print(f"✅ Рендер готов: воркер {args[0]} прогрелся за {args[1]:.1f}с")
+            return
+        if kind == "stats":
+            self._record_stats(*args)
+            return
+        if kind == "worker_died":
+            # Событие taken могло не успеть уйти из упавшего воркера, поэтому
+            # проваливаем и батчи, которые ещё никто не взял
+            self._fail_batches(lambda pid: pid in (args[0], None), "Процесс рендера упал")
+            return
+        batch = self._batches.get(args[0])
+        if batch is None:
+            return
+        future, progress, _ = batch
+        if kind == "taken":
+            batch[2] = args[1]
+        elif kind == "progress":
+            if progress is not None:
+                progress(*args[1:])
+        elif future.done():
+            return
+        elif kind == "done":
+            future.set_result(args[1])
+            self._record_timings(args[2])
+        elif kind == "error":
+            future.set_exception(RenderError(args[1]))
+
+    @staticmethod
+    def _record_timings(timings: dict):
+        for stage, seconds in timings.items():
+            if stage == "unet_steps":
+                for step_seconds in seconds:
+                    metrics.render_stage_seconds.observe(step_seconds, stage="unet_step")
+            else:
+                metrics.render_stage_seconds.observe(seconds, stage=stage)
+
+    @staticmethod
+    def _record_stats(memory: dict, threads: int):
+        # Процессы рендера приходят целиком: упавшие воркеры из метрик пропадают
+        metrics.process_memory_bytes.clear()
+        for process, values in memory.items():
+            for kind, value in values.items():
+                metrics.process_memory_bytes.set(value, process=process, kind=kind)
+        metrics.torch_threads.set(threads)
+
+    def _set_state(self, state: str):
+        self.state = state
+        if state == "ready":
+            self._ready.set()
+        else:
+            self._ready.clear()
+
+    def _kill_host(self):
+        try:
+            os.killpg(self.process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+    def _fail_batches(self, taken_by, message: str):
+        # taken_by(pid) выбирает батчи по pid взявшего воркера (None — ещё не взят);
+        # taken_by=None — вообще все
+        for future, _, pid in list(self._batches.values()):
+            if future.done():
+                continue
+            if taken_by is None or taken_by(pid):
+                future.set_exception(RenderError(message))
+
+    def _host_exited(self, exitcode):
+        if self._stopping:
+            return
+        delay = min(RESTART_DELAY * 2 ** self._failures, RESTART_MAX_DELAY)
+        self._failures += 1
+        print(f"❌ Процесс рендера завершился (код {exitcode}), перезапуск через {delay:.0f}с")
+        self._set_state("failed")
+        # Осиротевшие воркеры упавшего хоста не доделывают батчи, которые уже некому отдать
+        self._kill_host()
+        self._fail_batches(None, "Процесс рендера упал")
+        self._loop.call_later(delay, self._restart)
+
+    def _restart(self):
+        if not self._stopping:
+            self.start()
+
+
+def _run_host(connection: Connection):
+    import model
+
+    workers, load_options = connection.recv()
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    # Очереди воркеров создаём до загрузки: задачи от бота копятся в них,
+    # пока грузится модель, и бот не упирается в заполненный сокет
+    context = multiprocessing.get_context("fork")
+    inbox, outbox = context.Queue(), context.Queue()
+    lock = threading.Lock()
+
+    def send(event):
+        with lock:
+            connection.send(event)
+
+    threading.Thread(target=_relay_jobs, args=(connection, inbox), name="relay-jobs", daemon=True).start()
+    threading.Thread(target=_relay_events, args=(outbox, send), name="relay-events", daemon=True).start()
+    send(("state", "loading", {}))
+    try:
+        # Грузим в один поток без прогрева: пул OpenMP, поднятый до fork,
+        # в дочерних процессах зависает. Потоки и прогрев — уже в воркерах
+        model.load_model(threads=1, warm=False, **load_options)
+    except Exception:
+        # Выходим с ошибкой: бот провалит ждущие батчи и перезапустит хост с паузой
+        send(("state", "failed", {}))
+        # Задачи в inbox никто не заберёт — не ждём, пока они уйдут в канал
+        inbox.cancel_join_thread()
+        sys.exit(1)
+    # Готовность объявит первый прогревшийся воркер
+    send(("state", "loading", dict(model.load_timings)))
+    # Объекты модели больше не меняются: убираем их из-под GC, чтобы
+    # обход сборщика в воркерах не рвал copy-on-write страницы
+    gc.freeze()
+    processes = {}
+
+    def fork_worker():
+        process = context.Process(target=_run_worker, args=(inbox, outbox, threads, connection), daemon=True)
+        process.start()
+        processes[process.sentinel] = process
+
+    for _ in range(workers):
+        fork_worker()
+    print(f"🧵 Воркеров рендера: {workers}, по {threads} потоков")
+    stats_at = 0.0
+    while processes:
+        if time.monotonic() - stats_at >= STATS_INTERVAL:
+            stats_at = time.monotonic()
+            memory = {"render-host": metrics.process_memory()}
+            for process in processes.values():
+                memory[f"render-worker-{process.pid}"] = metrics.process_memory(process.pid)
+            send(("stats", memory, threads))
+        for sentinel in wait(list(processes), timeout=STATS_INTERVAL):
+            process = processes.pop(sentinel)
+            process.join()
+            if process.exitcode != 0:
+                # Веса уже в памяти хоста — новый воркер форкается за секунды
+                print(f"⚠️ Воркер рендера {process.pid} упал (код {process.exitcode}), перезапускаю")
+                send(("worker_died", process.pid))
+                time.sleep(WORKER_RESTART_DELAY)
+                fork_worker()
+
+
+def _relay_jobs(connection: Connection, inbox):
+    while True:
+        try:
+            task = connection.recv()
+        except (EOFError, OSError):
+            # Бот завершился, не остановив пул: рендерить больше некому
+            os._exit(0)
+        inbox.put(task)
+
+
+def _relay_events(outbox, send):
+    while True:
+        send(outbox.get())
+
+
+def _run_worker(jobs, events, threads: int, connection: Connection):
+    import torch
+    import imaging
+    import model
+
+    # Копия сокета хоста воркеру не нужна: иначе бот не увидит конец
+    # соединения, пока живут осиротевшие воркеры
+    connection.close()
+    torch.set_num_threads(threads)
+    host = os.getppid()
+    started = time.perf_counter()
+    try:
+        model.warmup()
+    except Exception as e:
+        print(f"⚠️ Прогрев воркера {os.getpid()} не удался: {e}")
+    events.put(("warmed", os.getpid(), time.perf_counter() - started))
+    while True:
+        try:
+            task = jobs.get(timeout=5)
+        except queue.Empty:
+            # Хост убит — не оставляем осиротевших воркеров
+            if os.getppid() != host:
+                return
+            continue
+        if task is None:
+            return
+        batch_id, items, options = task
+        events.put(("taken", batch_id, os.getpid()))
+
+        def progress(index, step, total, preview):
+            events.put(("progress", batch_id, index, step, total, preview))
+
+        try:
+            for item in items:
+                if item.get("image_embeds") is not None:
+                    item["image_embeds"] = model.load_image_embeds(item["image_embeds"])
+            timings = {}
+            results = model.render_batch(items, **options, progress=progress, timings=timings)
+            started = time.perf_counter()
+            encoded = [
+                (imaging.encode_jpeg(image), model.dump_image_embeds(image_embeds))
+                for image, image_embeds in results
+            ]
+            timings["jpeg_encode"] = time.perf_counter() - started
+            events.put(("done", batch_id, encoded, timings))
+        except Exception as e:
+            events.put(("error", batch_id, f"{type(e).__name__}: {e}"))
+
+
+if __name__ == "__main__":
+    _run_host(Connection(int(sys.argv[1])))
@@ -0,0 +1,256 @@
+import asyncio
+import dataclasses
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StorageKey
+
+# === ХРАНИЛИЩЕ ===
+# SQLite в WAL-режиме. Все запросы идут через один поток, поэтому event loop
+# не блокируется, а операции с балансом выполняются атомарно на стороне SQLite.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS balances (
+    user_id INTEGER PRIMARY KEY,
+    balance INTEGER NOT NULL DEFAULT 0,
+    tier TEXT NOT NULL DEFAULT 'full'
+);
+CREATE TABLE IF NOT EXISTS payments (
+    charge_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    packet TEXT NOT NULL,
+    generations INTEGER NOT NULL,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS analytics (
+    style TEXT NOT NULL,
+    substyle TEXT NOT NULL,
+    outcome TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (style, substyle, outcome)
+);
+CREATE TABLE IF NOT EXISTS migrations (
+    name TEXT PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS fsm (
+    key TEXT PRIMARY KEY,
+    state TEXT,
+    data TEXT NOT NULL DEFAULT '{}'
+);
+CREATE TABLE IF NOT EXISTS jobs (
+    render_id TEXT PRIMARY KEY,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    message_id INTEGER NOT NULL,
+    main_style TEXT NOT NULL,
+    substyle TEXT NOT NULL,
+    photo_key TEXT NOT NULL,
+    photo_id TEXT,
+    seed INTEGER NOT NULL,
+    tier TEXT NOT NULL,
+    paid INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    created_at TEXT NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+"""
+# Поля задачи, которых достаточно, чтобы поставить её заново после перезапуска
+JOB_COLUMNS = (
+    "render_id", "user_id", "chat_id", "message_id", "main_style", "substyle",
+    "photo_key", "photo_id", "seed", "tier", "paid"
+)
+# Таблица analytics больше не пополняется (счётчики генераций теперь в /metrics),
+# но старые данные и перенос из analytics.json остаются как история
+STATS_UPSERT = (
+    "INSERT INTO analytics (style, substyle, outcome, count) VALUES (?, ?, ?, ?) "
+    "ON CONFLICT(style, substyle, outcome) DO UPDATE SET count = count + excluded.count"
+)
+
+
+class Storage:
+    def __init__(self, path: str):
+        self.path = path
+        self.db = None
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="storage")
+
+    async def _run(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+
+    async def open(self, balance_file: str = None, analytics_file: str = None):
+        await self._run(self._open, balance_file, analytics_file)
+
+    def _open(self, balance_file, analytics_file):
+        self.db = sqlite3.connect(self.path, check_same_thread=False, isolation_level=None)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(SCHEMA)
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(balances)")]
+        if "tier" not in columns:
+            self.db.execute("ALTER TABLE balances ADD COLUMN tier TEXT NOT NULL DEFAULT 'full'")
+        self._migrate(balance_file, analytics_file)
+
+    async def close(self):
+        await self._run(self.db.close)
+        self.executor.shutdown(wait=True)
+
+    # --- Миграция со старых JSON-файлов ---
+    def _migrate(self, balance_file, analytics_file):
+        if balance_file and os.path.exists(balance_file):
+            with open(balance_file, "r") as f:
+                balances = json.load(f)
+            self._migrate_once(balance_file, lambda: self.db.executemany(
+                "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+                "ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance",
+                [(int(user_id), int(balance)) for user_id, balance in balances.items()]
+            ))
+            print(f"📦 Балансы перенесены в SQLite: {len(balances)} пользователей")
+
+        if analytics_file and os.path.exists(analytics_file):
+            with open(analytics_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            # Старый формат не различал успешные генерации и превью
+            rows = [
+                (style, substyle, "legacy", count)
+                for style, info in data.get("styles", {}).items()
+                for substyle, count in info.get("substyles", {}).items()
+            ]
+            self._migrate_once(analytics_file, lambda: self.db.executemany(STATS_UPSERT, rows))
+            print(f"📦 Аналитика перенесена в SQLite: {len(rows)} записей")
+
+    def _migrate_once(self, path, apply):
+        # Отметка о миграции пишется в той же транзакции, что и данные,
+        # так что падение до переименования файла не задвоит балансы
+        name = os.path.basename(path)
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            done = self.db.execute("SELECT 1 FROM migrations WHERE name = ?", (name,)).fetchone()
+            if not done:
+                apply()
+                self.db.execute("INSERT INTO migrations (name) VALUES (?)", (name,))
+        os.replace(path, path + ".migrated")
+
+    # --- Баланс ---
+    async def get_balance(self, user_id: int) -> int:
+        return await self._run(self._get_balance, user_id)
+
+    def _get_balance(self, user_id):
+        row = self.db.execute("SELECT balance FROM balances WHERE user_id = ?", (user_id,)).fetchone()
+        return row[0] if row else 0
+
+    async def add_balance(self, user_id: int, delta: int):
+        await self._run(self._add_balance, user_id, delta)
+
+    def _add_balance(self, user_id, delta):
+        self.db.execute(
+            "INSERT INTO balances (user_id, balance) VALUES (?, ?) "
+            "ON CONFLICT(user_id) DO UPDATE SET balance = balance + excluded.balance",
+            (user_id, delta)
+        )
+
+    async def charge(self, user_id: int, amount: int = 1):
+        # Списывает только если хватает баланса. Возвращает тариф пользователя
+        # (тариф последнего купленного пакета) или None, если списать нечего
+        return await self._run(self._charge, user_id, amount)
+
+    def _charge(self, user_id, amount):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            cursor = self.db.execute(
+                "UPDATE balances SET balance = balance - ? WHERE user_id = ? AND balance >= ?",
+                (amount, user_id, amount)
+            )
+            if cursor.rowcount != 1:
+                return None
+            return self.db.execute("SELECT tier FROM balances WHERE user_id = ?", (user_id,)).fetchone()[0]
+
+    async def add_payment(self, charge_id: str, user_id: int, packet: str, generations: int,
+                          tier: str = "full") -> bool:
+        # Повторная доставка того же платежа баланс не меняет; False — уже учтён
+        return await self._run(self._add_payment, charge_id, user_id, packet, generations, tier)
+
+    def _add_payment(self, charge_id, user_id, packet, generations, tier):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            cursor = self.db.execute(
+                "INSERT OR IGNORE INTO payments (charge_id, user_id, packet, generations) VALUES (?, ?, ?, ?)",
+                (charge_id, user_id, packet, generations)
+            )
+            if cursor.rowcount == 0:
+                return False
+            self._add_balance(user_id, generations)
+            self.db.execute("UPDATE balances SET tier = ? WHERE user_id = ?", (tier, user_id))
+        return True
+
+    # --- Журнал задач ---
+    # Задача пишется в журнал до постановки в очередь и удаляется после ответа
+    # пользователю; всё, что осталось в журнале при старте, — прерванные рендеры
+    async def add_job(self, job: dict):
+        await self._run(self._add_job, job)
+
+    def _add_job(self, job):
+        self.db.execute(
+            f"INSERT OR REPLACE INTO jobs ({', '.join(JOB_COLUMNS)}) "
+            f"VALUES ({', '.join('?' * len(JOB_COLUMNS))})",
+            [job[column] for column in JOB_COLUMNS]
+        )
+
+    async def finish_job(self, render_id: str):
+        await self._run(self.db.execute, "DELETE FROM jobs WHERE render_id = ?", (render_id,))
+
+    async def resume_jobs(self) -> list:
+        # Возвращает незавершённые задачи, засчитывая каждой ещё одну попытку
+        return await self._run(self._resume_jobs)
+
+    def _resume_jobs(self):
+        with self.db:
+            self.db.execute("BEGIN IMMEDIATE")
+            self.db.execute("UPDATE jobs SET attempts = attempts + 1")
+            cursor = self.db.execute(
+                f"SELECT {', '.join(JOB_COLUMNS)}, attempts FROM jobs ORDER BY created_at, rowid"
+            )
+            return [dict(zip(JOB_COLUMNS + ("attempts",), row)) for row in cursor]
+
+    # --- FSM ---
+    def _get_fsm(self, key):
+        row = self.db.execute("SELECT state, data FROM fsm WHERE key = ?", (key,)).fetchone()
+        return (row[0], json.loads(row[1])) if row else (None, {})
+
+    def _set_fsm(self, key, column, value):
+        # Пустые записи не храним, чтобы таблица не росла с каждым /start
+        with self.db:
+            self.db.execute("BEGIN")
+            self.db.execute(
+                f"INSERT INTO fsm (key, {column}) VALUES (?, ?) "
+                f"ON CONFLICT(key) DO UPDATE SET {column} = excluded.{column}",
+                (key, value)
+            )
+            self.db.execute("DELETE FROM fsm WHERE key = ? AND state IS NULL AND data = '{}'", (key,))
+
+
+# FSM aiogram в той же базе: шаг диалога и выбранное фото переживают перезапуск сервиса
+class SQLiteFSMStorage(BaseStorage):
+    def __init__(self, storage: Storage):
+        self.storage = storage
+
+    @staticmethod
+    def _key(key: StorageKey) -> str:
+        return ":".join(str(value) for value in dataclasses.astuple(key))
+
+    async def set_state(self, key: StorageKey, state=None):
+        state = state.state if isinstance(state, State) else state
+        await self.storage._run(self.storage._set_fsm, self._key(key), "state", state)
+
+    async def get_state(self, key: StorageKey):
+        state, _ = await self.storage._run(self.storage._get_fsm, self._key(key))
+        return state
+
+    async def set_data(self, key: StorageKey, data: dict):
+        await self.storage._run(self.storage._set_fsm, self._key(key), "data", json.dumps(data, ensure_ascii=False))
+
+    async def get_data(self, key: StorageKey) -> dict:
+        _, data = await self.storage._run(self.storage._get_fsm, self._key(key))
+        return data
+
+    async def close(self):
+        # Соединением владеет Storage, оно закрывается в storage.close()
+        pass
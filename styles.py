@@ -0,0 +1,30 @@
+import json
+import os
+
+# === СТИЛИ ===
+# Каталог лежит в styles.json: main_style → {title, substyles: {substyle → {title, prompt}}}.
+# Читается один раз при импорте, дальше — готовые словари.
+CATALOG_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "styles.json")
+
+with open(CATALOG_FILE, "r", encoding="utf-8") as f:
+    CATALOG = json.load(f)
+
+MAIN_STYLES = {key: style["title"] for key, style in CATALOG.items()}
+SUBSTYLES = {
+    key: {substyle: info["prompt"] for substyle, info in style["substyles"].items()}
+    for key, style in CATALOG.items()
+}
+
+# Роутинг кнопок: текст кнопки → ключ одним обращением к словарю.
+# Подстили ищутся в рамках основного стиля — одинаковые ключи (rock_portrait)
+# в разных стилях друг другу не мешают
+MAIN_STYLE_BY_TITLE = {title: key for key, title in MAIN_STYLES.items()}
+SUBSTYLE_BY_TITLE = {
+    (key, info["title"]): substyle
+    for key, style in CATALOG.items()
+    for substyle, info in style["substyles"].items()
+}
+if len(MAIN_STYLE_BY_TITLE) != len(MAIN_STYLES):
+    raise ValueError(f"{CATALOG_FILE}: у основных стилей повторяются названия")
+if len(SUBSTYLE_BY_TITLE) != sum(len(substyles) for substyles in SUBSTYLES.values()):
+    raise ValueError(f"{CATALOG_FILE}: внутри стиля повторяются названия подстилей")
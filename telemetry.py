@@ -0,0 +1,43 @@
+import time
+from aiohttp import web
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+import metrics
+
+# === /metrics ===
+# HTTP-эндпоинт Prometheus в том же event loop, что и бот (aiohttp уже
+# стоит как зависимость aiogram), плюс замер задержки запросов к Bot API.
+
+
+class TelegramLatency(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        # getUpdates — long polling, его время ничего не говорит о задержке
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        started = time.perf_counter()
+        status = "error"
+        try:
+            response = await make_request(bot, method)
+            status = "ok"
+            return response
+        finally:
+            metrics.telegram_request_seconds.observe(
+                time.perf_counter() - started, method=type(method).__name__, status=status
+            )
+
+
+async def handle_metrics(request: web.Request) -> web.Response:
+    # Память процесса бота снимаем на каждом запросе; процессы рендера присылают свою сами
+    for kind, value in metrics.process_memory().items():
+        metrics.process_memory_bytes.set(value, process="bot", kind=kind)
+    return web.Response(body=metrics.exposition().encode(), headers={"Content-Type": metrics.CONTENT_TYPE})
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    app.router.add_get("/metrics", handle_metrics)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    print(f"📈 Метрики: http://{host}:{port}/metrics")
+    return runner
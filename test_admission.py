@@ -0,0 +1,71 @@
+import asyncio
+import unittest
+from types import SimpleNamespace
+from admission import RenderAdmission
+
+
+class FakeQueue:
+    pending = []
+
+    def find(self, *args):
+        return None
+
+    def user_jobs(self, user_id):
+        return 0
+
+    def user_rate(self, user_id):
+        return 0
+
+
+class FakeState:
+    async def get_data(self):
+        # Поход в SQLite через поток хранилища
+        await asyncio.sleep(0.01)
+        return {"main_style": "anime", "photo_key": "photo"}
+
+
+def make_event(user_id: int, text: str):
+    answers = []
+
+    async def answer(text):
+        answers.append(text)
+
+    return SimpleNamespace(from_user=SimpleNamespace(id=user_id), text=text, answer=answer, answers=answers)
+
+
+class RenderAdmissionTest(unittest.IsolatedAsyncioTestCase):
+    async def test_double_tap_runs_handler_once(self):
+        admission = RenderAdmission(FakeQueue(), storage=None)
+        calls = []
+
+        async def handler(event, data):
+            calls.append(event.text)
+            await asyncio.sleep(0.01)
+
+        def call(event):
+            data = {"state": FakeState(), "handler": SimpleNamespace(flags={"render": True})}
+            return admission(handler, event, data)
+
+        first, second = make_event(1, "Рок"), make_event(1, "Рок")
+        results = await asyncio.gather(call(first), call(second), return_exceptions=True)
+        self.assertEqual(calls, ["Рок"])
+        self.assertEqual(results, [None, None])
+        self.assertEqual(admission._handling, {})
+
+    async def test_other_users_are_not_blocked(self):
+        admission = RenderAdmission(FakeQueue(), storage=None)
+        calls = []
+
+        async def handler(event, data):
+            calls.append(event.from_user.id)
+
+        data = {"state": FakeState(), "handler": SimpleNamespace(flags={"render": True})}
+        await asyncio.gather(
+            admission(handler, make_event(1, "Рок"), dict(data)),
+            admission(handler, make_event(2, "Рок"), dict(data))
+        )
+        self.assertEqual(sorted(calls), [1, 2])
+
+
+if __name__ == "__main__":
+    unittest.main()